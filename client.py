@@ -4,7 +4,8 @@ from gevent.server import StreamServer
 from collections import namedtuple
 from io import BytesIO
 from socket import error as socket_error
-from database_server import ProtocolHandler, CommandError, Error
+from database_server import (ProtocolHandler, CommandError, Error,
+                             Incomplete, READ_BUF_SIZE)
 
 
 class Client(object):
@@ -12,30 +13,44 @@ class Client(object):
         self._protocol = ProtocolHandler()
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._socket.connect((host, port))
-        self._fh = self._socket.makefile('rwb')
+        self._buf = bytearray(READ_BUF_SIZE)
+        self._pos = self._end = 0
 
     def execute(self, *args):
-        self._protocol.write_response(self._fh, args)
-        resp = self._protocol.handle_request(self._fh)
+        self._protocol.write_response(self._socket, args)
+        progress = None
+        while True:
+            try:
+                if progress is None:
+                    resp, self._pos = self._protocol.handle_request(
+                        self._buf, self._pos, self._end)
+                else:
+                    resp, self._pos = self._protocol.resume(
+                        self._buf, self._pos, self._end, progress)
+                break
+            except Incomplete as exc:
+                progress = exc.args or None
+                self._buf, self._pos, self._end = self._protocol.fill(
+                    self._socket, self._buf, self._pos, self._end)
         if isinstance(resp, Error):
             raise CommandError(resp.message)
         return resp
 
     def get(self, key):
-        return self.execute('GET', key)
+        return self.execute(b'GET', key)
 
     def set(self, key, value):
-        return self.execute('SET', key, value)
+        return self.execute(b'SET', key, value)
 
     def delete(self, key):
-        return self.execute('DELETE', key)
+        return self.execute(b'DELETE', key)
 
     def flush(self):
-        return self.execute('FLUSH')
+        return self.execute(b'FLUSH')
 
     def mget(self, *keys):
-        return self.execute('MGET', *keys)
+        return self.execute(b'MGET', *keys)
 
     def mset(self, *items):
-        return self.execute('MSET', *items)
+        return self.execute(b'MSET', *items)
 
@@ -1,7 +1,8 @@
 from gevent import socket
 from gevent.pool import Pool
 from gevent.server import StreamServer
-from collections import namedtuple
+from array import array
+from collections import deque, namedtuple
 from io import BytesIO
 from socket import error as socket_error
 
@@ -44,95 +45,724 @@ class CommandError(Exception): pass
 class Disconnect(Exception): pass
 
 
+class Incomplete(Exception): pass
+
+
 Error = namedtuple('Error', ('message',))
 
 
-class ProtocolHandler(object):
-    def __init__(self):
-        self.handlers = {
-            b'+': self.handle_simple_string,
-            b'-': self.handle_error,
-            b':': self.handle_integer,
-            b'$': self.handle_string,
-            b'*': self.handle_array,
-            b'%': self.handle_dict}
-
-    def handle_request(self, socket_file):
-        first_byte = socket_file.read(1)
-        if not first_byte:
-            raise Disconnect
-        try:
-            return self.handlers[first_byte](socket_file)
-        except KeyError:
-            raise CommandError('bad request')
+CRLF = b'\r\n'
+NULL = b'$-1\r\n'
+
+# Pre-encoded headers for bulk strings and arrays shorter than
+# HEADER_CACHE_SIZE, so the common case skips formatting the length.
+HEADER_CACHE_SIZE = 256
+_BULK_HEADERS = [b'$%d\r\n' % n for n in range(HEADER_CACHE_SIZE)]
+_ARRAY_HEADERS = [b'*%d\r\n' % n for n in range(HEADER_CACHE_SIZE)]
+
+
+# Response buffers are pooled rather than allocated per response. BytesIO
+# keeps its storage when rewound with seek(0) (bytearray.clear() frees it),
+# so a pooled buffer only grows until it fits the responses it carries.
+# Buffers that grew past BUF_MAX_SIZE are dropped instead of being pooled.
+BUF_POOL_SIZE = 64
+BUF_DEFAULT_SIZE = 512
+BUF_MAX_SIZE = 64 * 1024
+_buf_pool = deque(maxlen=BUF_POOL_SIZE)
+
+
+# Bulk payloads of at least SPLICE_MIN_SIZE bytes are not copied into the
+# response buffer. The buffer records where they belong, and send() passes
+# them to sendmsg() by reference, interleaved with slices of the buffer (at
+# most IOV_MAX pieces per call). Smaller payloads are cheaper to copy.
+SPLICE_MIN_SIZE = 8 * 1024
+IOV_MAX = 1024
 
-    def handle_simple_string(self, socket_file):
-        return str(socket_file.readline().decode('utf-8')).rstrip('\r\n')
 
-    def handle_error(self, socket_file):
-        return Error(str(socket_file.readline().decode('utf-8')).rstrip('\r\n'))
+class ResponseBuffer(BytesIO):
+    __slots__ = ('spliced',)
 
-    def handle_integer(self, socket_file):
-        return int(str(socket_file.readline().decode('utf-8')).rstrip('\r\n'))
+    def __init__(self, initial_bytes=b''):
+        super().__init__(initial_bytes)
+        # (offset, payload) pairs for payloads left out of the buffer, or
+        # None once sending from the buffer failed.
+        self.spliced = []
 
-    def handle_string(self, socket_file):
-        length = int(str(socket_file.readline().decode('utf-8')).rstrip('\r\n'))
+
+def acquire_buffer():
+    if _buf_pool:
+        return _buf_pool.pop()
+    return ResponseBuffer(bytes(BUF_DEFAULT_SIZE))
+
+
+def release_buffer(buf):
+    # send() sets spliced to None when sending failed; see there.
+    if buf.spliced is None:
+        return
+    del buf.spliced[:]
+    if buf.seek(0, 2) <= BUF_MAX_SIZE:
+        buf.seek(0)
+        _buf_pool.append(buf)
+
+
+def _sendmsg_all(conn, iov):
+    # sendmsg() counterpart of sendall(): keep sending until every byte of
+    # iov has gone out, resuming partway through a piece if need be.
+    start = 0
+    while start < len(iov):
+        sent = conn.sendmsg(iov[start:start + IOV_MAX])
+        while start < len(iov) and sent >= len(iov[start]):
+            sent -= len(iov[start])
+            start += 1
+        if sent:
+            iov[start] = memoryview(iov[start])[sent:]
+
+
+# Initial size of the per-connection read buffer. It is doubled whenever a
+# single request does not fit. Read buffers are pooled across connections
+# as well, so short-lived connections don't each allocate and zero one;
+# buffers that had to grow are not returned to the pool.
+READ_BUF_SIZE = 64 * 1024
+_read_buf_pool = deque(maxlen=BUF_POOL_SIZE)
+
+
+def acquire_read_buffer():
+    return _read_buf_pool.pop() if _read_buf_pool else bytearray(READ_BUF_SIZE)
+
+
+def release_read_buffer(buf):
+    if len(buf) == READ_BUF_SIZE:
+        _read_buf_pool.append(buf)
+
+
+# When numba is installed, servers decode arrays of at least
+# NUMBA_MIN_ELEMENTS elements with a compiled version of the scan below.
+# numba is imported and the scan compiled by load_bulk_scan() when a Server
+# starts, so clients and plain module imports don't pay for either. Every
+# bulk string takes at least MIN_BULK_SIZE bytes ($0\r\n\r\n).
+NUMBA_MIN_ELEMENTS = 64
+MIN_BULK_SIZE = 6
+MAX_LENGTH_DIGITS = 18
+_BULK_SCAN_SIGNATURE = 'int64(uint8[::1], int64, int64, int64[:, ::1])'
+_bulk_scan = None
+
+
+def _scan_bulk_strings(data, pos, end, offsets):
+    # Locate len(offsets) consecutive non-null bulk strings starting at
+    # pos, storing each payload's (start, stop) in offsets. Returns the
+    # position after the last one, -1 if data ends first, or -2 if an
+    # element is anything other than a bulk string. Lengths are int64 here,
+    # so any longer than MAX_LENGTH_DIGITS digits, or past the end of the
+    # data, are left to the generic decoder rather than wrapping round.
+    for i in range(offsets.shape[0]):
+        if pos >= end:
+            return -1
+        if data[pos] != 36:  # '$'
+            return -2
+        pos += 1
+        digits = pos
+        length = 0
+        while True:
+            if pos >= end:
+                return -1
+            c = data[pos]
+            if c == 13:  # '\r'
+                break
+            if c < 48 or c > 57 or pos - digits >= MAX_LENGTH_DIGITS:
+                return -2
+            length = length * 10 + (c - 48)
+            pos += 1
+        if length > end:
+            return -2
+        pos += 2
+        stop = pos + length
+        if stop + 2 > end:
+            return -1
+        offsets[i, 0] = pos
+        offsets[i, 1] = stop
+        pos = stop + 2
+    return pos
+
+
+def load_bulk_scan():
+    # Return a function scanning count bulk strings out of a read buffer,
+    # as (next position, offsets array), compiling it on first use; or None
+    # if numba is not installed.
+    global _bulk_scan
+    if _bulk_scan is None:
+        try:
+            import numba
+            import numpy
+        except ImportError:
+            _bulk_scan = False
+        else:
+            scan = numba.njit(_BULK_SCAN_SIGNATURE, cache=True)(
+                _scan_bulk_strings)
+
+            def bulk_scan(buf, pos, end, count):
+                offsets = numpy.empty((count, 2), numpy.int64)
+                next_pos = scan(numpy.frombuffer(buf, numpy.uint8),
+                                pos, end, offsets)
+                return next_pos, offsets
+
+            _bulk_scan = bulk_scan
+    return _bulk_scan or None
+
+
+# Array requests of up to SPECIALIZE_MAX_ARITY elements are counted by
+# length, and once HOT_SHAPE_THRESHOLD of one length have been seen a
+# decoder unrolled for their shape (the type prefix of each element) is
+# compiled. The per element templates below are filled in and exec'd by
+# ProtocolHandler.specialize().
+HOT_SHAPE_THRESHOLD = 1000
+SPECIALIZE_MAX_ARITY = 8
+_SHAPE_PREFIXES = {bytes: '$', str: '+'}
+
+_SPECIALIZED_PARSE = '''\
+def parse(buf, pos, end):
+%s
+    return [%s], pos
+'''
+
+_SPECIALIZED_ELEMENTS = {
+    '$': '''\
+    if pos >= end:
+        raise Incomplete
+    if buf[pos] != 36:
+        return None
+    idx = buf.find(CRLF, pos + 1, end)
+    if idx == -1:
+        raise Incomplete
+    if idx == pos + 2 and 48 <= buf[pos + 1] <= 57:
+        length = buf[pos + 1] - 48
+    else:
+        length = int(buf[pos + 1:idx])
+    if length < 0:
+        return None
+    pos = idx + 2 + length
+    if pos + 2 > end:
+        raise Incomplete
+    v%(n)d = bytes(buf[idx + 2:pos])
+    pos += 2''',
+    '+': '''\
+    if pos >= end:
+        raise Incomplete
+    if buf[pos] != 43:
+        return None
+    idx = buf.find(CRLF, pos + 1, end)
+    if idx == -1:
+        raise Incomplete
+    v%(n)d = buf[pos + 1:idx].decode('utf-8')
+    pos = idx + 2''',
+}
+
+
+class ProtocolHandler(object):
+    def __init__(self, bulk_scan=None):
+        # Indexed by the first byte of a value; None marks a bad prefix.
+        self.handlers = [None] * 256
+        self.handlers[ord('+')] = self.handle_simple_string
+        self.handlers[ord('-')] = self.handle_error
+        self.handlers[ord(':')] = self.handle_integer
+        self.handlers[ord('$')] = self.handle_string
+        self.handlers[ord('*')] = self.handle_array
+        self.handlers[ord('%')] = self.handle_dict
+        # Decoders compiled by specialize(), keyed by array length.
+        self.specialized = {}
+        # Compiled scan for large bulk-string arrays, see load_bulk_scan().
+        self.bulk_scan = bulk_scan
+
+    def specialize(self, shape):
+        # Compile and install a decoder for arrays whose elements carry the
+        # type prefixes in shape, e.g. '$$$' for three bulk strings. It
+        # returns None for any array of that length that does not match.
+        body = '\n'.join(_SPECIALIZED_ELEMENTS[prefix] % {'n': n}
+                         for n, prefix in enumerate(shape))
+        names = ', '.join('v%d' % n for n in range(len(shape)))
+        namespace = {'CRLF': CRLF, 'Incomplete': Incomplete}
+        exec(_SPECIALIZED_PARSE % (body, names), namespace)
+        self.specialized[len(shape)] = namespace['parse']
+
+    def fill(self, conn, buf, pos, end):
+        # Read more data into buf, first moving the unparsed tail buf[pos:end]
+        # to the front (or into a larger buffer if it already fills buf).
+        # Returns the buffer to use along with the new pos and end.
+        pending = end - pos
+        if pending == len(buf):
+            grown = bytearray(2 * len(buf))
+            grown[:pending] = buf
+            buf = grown
+        elif pos:
+            buf[:pending] = buf[pos:end]
+        with memoryview(buf) as view:
+            received = conn.recv_into(view[pending:])
+        if not received:
+            raise Disconnect
+        return buf, 0, pending + received
+
+    def handle_request(self, buf, pos, end):
+        # Decode one value from buf[pos:end], returning it along with the
+        # position just past it. Incomplete is raised when buf does not yet
+        # hold the whole value; the caller fills and retries from pos. When
+        # the value is an array, Incomplete carries the decoding progress so
+        # far: pass its args to resume() rather than starting over, so a
+        # request arriving over many reads is only decoded once.
+        if pos >= end:
+            raise Incomplete
+        handler = self.handlers[buf[pos]]
+        if handler is None:
+            raise CommandError('bad request')
+        return handler(buf, pos + 1, end)
+
+    def resume(self, buf, pos, end, progress):
+        # Carry on decoding the array starting at pos from where the
+        # Incomplete raised while decoding it (with args progress) left off.
+        offset, elements, num_elements = progress
+        return self._decode_elements(buf, pos, pos + offset, end, elements,
+                                     num_elements)
+
+    def handle_simple_string(self, buf, pos, end):
+        idx = buf.find(CRLF, pos, end)
+        if idx == -1:
+            raise Incomplete
+        return buf[pos:idx].decode('utf-8'), idx + 2
+
+    def handle_error(self, buf, pos, end):
+        idx = buf.find(CRLF, pos, end)
+        if idx == -1:
+            raise Incomplete
+        return Error(buf[pos:idx].decode('utf-8')), idx + 2
+
+    def handle_integer(self, buf, pos, end):
+        idx = buf.find(CRLF, pos, end)
+        if idx == -1:
+            raise Incomplete
+        return int(buf[pos:idx]), idx + 2
+
+    def handle_string(self, buf, pos, end):
+        idx = buf.find(CRLF, pos, end)
+        if idx == -1:
+            raise Incomplete
+        # Most length prefixes are a single digit; reading it straight from
+        # the buffer is about 3x faster than int() on a slice. -1 is a null;
+        # anything lower would make the decoder step backwards.
+        if idx == pos + 1 and 48 <= buf[pos] <= 57:
+            length = buf[pos] - 48
+        else:
+            length = int(buf[pos:idx])
+            if length < -1:
+                raise CommandError('bad length')
         if length == -1:
-            return None
-        length += 2
-        return socket_file.read(length)[:-2]
-
-    def handle_array(self, socket_file):
-        num_elements = int(str(socket_file.readline().decode('utf-8')).rstrip('\r\n'))
-        return [self.handle_request(socket_file) for _ in range(num_elements)]
-
-    def handle_dict(self, socket_file):
-        num_items = int(str(socket_file.readline().decode('utf-8')).rstrip('\r\n'))
-        elements = [self.handle_request(socket_file)
-                    for _ in range(num_items * 2)]
-        return dict(zip(elements[::2], elements[1::2]))
-
-    def write_response(self, socket_file, data):
-        buf = BytesIO()
+            return None, idx + 2
+        pos = idx + 2
+        stop = pos + length
+        if stop + 2 > end:
+            raise Incomplete
+        return bytes(buf[pos:stop]), stop + 2
+
+    def handle_array(self, buf, pos, end):
+        start = pos - 1
+        idx = buf.find(CRLF, pos, end)
+        if idx == -1:
+            raise Incomplete
+        if idx == pos + 1 and 48 <= buf[pos] <= 57:
+            num_elements = buf[pos] - 48
+        else:
+            num_elements = int(buf[pos:idx])
+            if num_elements < -1:
+                raise CommandError('bad length')
+        pos = idx + 2
+        parse = self.specialized.get(num_elements)
+        if parse is not None:
+            result = parse(buf, pos, end)
+            if result is not None:
+                return result
+        return self._decode_elements(buf, start, pos, end, [], num_elements)
+
+    def _decode_elements(self, buf, start, pos, end, elements, num_elements):
+        # Decode the elements of the array at start from pos on, appending
+        # them to elements until it holds num_elements.
+        remaining = num_elements - len(elements)
+        # Large arrays are usually all bulk strings (MSET, MGET); find every
+        # payload in one compiled pass and only fall back to the generic
+        # decoder when the array holds anything else or is not all there
+        # yet. The offsets array is sized from the untrusted count, so the
+        # scan only runs once enough data has arrived for that many bulk
+        # strings.
+        if (self.bulk_scan is not None and
+                remaining >= NUMBA_MIN_ELEMENTS and
+                remaining * MIN_BULK_SIZE <= end - pos):
+            next_pos, offsets = self.bulk_scan(buf, pos, end, remaining)
+            if next_pos > pos:
+                elements.extend([bytes(buf[first:last])
+                                 for first, last in offsets.tolist()])
+                return elements, next_pos
+        # Elements decoded before running out of data are kept, along with
+        # where the next one starts relative to the array, so that once more
+        # data has arrived resume() can carry on from there. An enclosing
+        # array or dict replaces the progress with its own (or drops it).
+        try:
+            for _ in range(remaining):
+                item, pos = self.handle_request(buf, pos, end)
+                elements.append(item)
+        except Incomplete:
+            raise Incomplete(pos - start, elements, num_elements) from None
+        return elements, pos
+
+    def handle_dict(self, buf, pos, end):
+        idx = buf.find(CRLF, pos, end)
+        if idx == -1:
+            raise Incomplete
+        if idx == pos + 1 and 48 <= buf[pos] <= 57:
+            num_items = buf[pos] - 48
+        else:
+            num_items = int(buf[pos:idx])
+            if num_items < -1:
+                raise CommandError('bad length')
+        pos = idx + 2
+        items = {}
+        try:
+            for _ in range(num_items):
+                key, pos = self.handle_request(buf, pos, end)
+                items[key], pos = self.handle_request(buf, pos, end)
+        except Incomplete:
+            # Progress in a nested array is relative to that array; the
+            # dict is decoded again from the start.
+            raise Incomplete from None
+        return items, pos
+
+    def write_response(self, conn, data):
+        buf = acquire_buffer()
+        try:
+            self.encode(buf, data)
+            self.send(conn, buf)
+        finally:
+            release_buffer(buf)
+
+    def encode(self, buf, data):
+        # Append the encoding of data at the buffer's current position.
         self._write(buf, data)
+
+    def send(self, conn, buf):
+        # Send everything encoded into buf straight from its storage
+        # (getvalue() would copy it), along with any spliced payloads, then
+        # rewind it for reuse.
+        size = buf.tell()
+        try:
+            with buf.getbuffer() as view:
+                if not buf.spliced:
+                    conn.sendall(view[:size])
+                else:
+                    iov = []
+                    last = 0
+                    for offset, payload in buf.spliced:
+                        if offset > last:
+                            iov.append(view[last:offset])
+                        iov.append(payload)
+                        last = offset
+                    iov.append(view[last:size])
+                    del buf.spliced[:]
+                    _sendmsg_all(conn, iov)
+                    # Drop the slices so the view can be released.
+                    del iov
+        except BaseException:
+            # The frames in the traceback still refer to slices of the
+            # buffer, which cannot be written to while they are alive, so
+            # have release_buffer() drop it rather than pool it.
+            buf.spliced = None
+            raise
         buf.seek(0)
-        socket_file.write(buf.getvalue())
-        socket_file.flush()
 
     def _write(self, buf, data):
-        if isinstance(data, str):
-            buf.write(f'+{data}\r\n'.encode('utf-8'))
-        elif isinstance(data, bytes):
-            buf.write(f'${len(data)}\r\n{data}\r\n'.encode('utf-8'))
-        elif isinstance(data, int):
-            buf.write(f':{data}\r\n'.encode('utf-8'))
-        elif isinstance(data, Error):
-            buf.write(f'-{Error.message}\r\n'.encode('utf-8'))
-        elif isinstance(data, (list, tuple)):
-            buf.write(f'*{len(data)}\r\n'.encode('utf-8'))
-            for item in data:
-                self._write(buf, item)
-        elif isinstance(data, dict):
-            buf.write(f'%%{len(data)}\r\n'.encode('utf-8'))
-            for key in data:
-                self._write(buf, key)
-                self._write(buf, data[key])
-        elif data is None:
-            buf.write('$-1\r\n'.encode('utf-8'))
+        # Encode iteratively from an explicit stack rather than recursing, so
+        # nested arrays and dicts cost no Python call per element. Exact
+        # types are matched by identity; subclasses (bool, str subclasses,
+        # other namedtuples...) are converted to their base type and retried.
+        write = buf.write
+        splice = buf.spliced.append
+        stack = [data]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            data = pop()
+            cls = type(data)
+            if cls is bytes:
+                length = len(data)
+                write(_BULK_HEADERS[length] if length < HEADER_CACHE_SIZE
+                      else b'$%d\r\n' % length)
+                if length < SPLICE_MIN_SIZE:
+                    write(data)
+                else:
+                    splice((buf.tell(), data))
+                write(CRLF)
+            elif cls is str:
+                write(b'+%s\r\n' % data.encode('utf-8'))
+            elif cls is int:
+                write(b':%d\r\n' % data)
+            elif data is None:
+                write(NULL)
+            elif cls is Error:
+                write(b'-%s\r\n' % data.message.encode('utf-8'))
+            elif cls is list or cls is tuple:
+                length = len(data)
+                write(_ARRAY_HEADERS[length] if length < HEADER_CACHE_SIZE
+                      else b'*%d\r\n' % length)
+                stack.extend(reversed(data))
+            elif cls is dict:
+                write(b'%%%d\r\n' % len(data))
+                for key in reversed(data):
+                    push(data[key])
+                    push(key)
+            elif isinstance(data, Error):
+                push(Error(data.message))
+            elif isinstance(data, str):
+                push(str(data))
+            elif isinstance(data, bytes):
+                push(bytes(data))
+            elif isinstance(data, int):
+                push(int(data))
+            elif isinstance(data, (list, tuple)):
+                push(list(data))
+            elif isinstance(data, dict):
+                push(dict(data))
+            else:
+                raise CommandError('Unrecognized type %s' % type(data))
+
+
+# Source templates for the per-command handlers built by
+# Server.compile_commands(); a is the request list, command name first.
+_COMMAND_TEMPLATE = '''\
+def handle(a):
+    if len(a) != %(size)d:
+        raise CommandError(%(error)r)
+    return method(%(args)s)
+'''
+
+_VARIADIC_COMMAND_TEMPLATE = '''\
+def handle(a):
+    return method(*a[1:])
+'''
+
+
+# Upper bound on the number of distinct spellings of command names (e.g.
+# b'get', b'GET', 'Get') a Server caches the normalised form of.
+COMMAND_CACHE_SIZE = 256
+
+
+# TypedKV starts with a table of KV_MIN_TABLE_SIZE positions, kept between
+# 1/3 and 2/3 full, and compacts its data once at least
+# KV_COMPACT_MIN_GARBAGE bytes, and more than half of it, belong to
+# overwritten or deleted entries.
+KV_MIN_TABLE_SIZE = 64
+KV_COMPACT_MIN_GARBAGE = 64 * 1024
+
+
+class TypedKV(object):
+    # Key-value store laid out as structure-of-arrays: each bytes key and
+    # its bytes value are packed back to back in one bytearray, the entry's
+    # hash and offsets live in array('q') columns, and an open-addressing
+    # table of entry numbers (also an array('q')) finds them. Unlike a dict
+    # it keeps no Python object per entry, which is what makes it smaller.
+    # Other keys and values (str keys, non-bytes values) are kept in a
+    # plain dict. Supports the subset of the dict interface Server uses.
+    def __init__(self):
+        # Table positions hold 0 when empty, -1 when deleted and otherwise
+        # the entry number plus one.
+        self._table = array('q', bytes(8 * KV_MIN_TABLE_SIZE))
+        self._used = 0
+        # Entry columns: hash, then offsets of the key, the value and the
+        # end of the value in _data.
+        self._hashes = array('q')
+        self._starts = array('q')
+        self._splits = array('q')
+        self._stops = array('q')
+        self._data = bytearray()
+        self._live = 0
+        self._garbage = 0
+        self._objects = {}
+
+    def __len__(self):
+        return self._live + len(self._objects)
+
+    def __contains__(self, key):
+        if isinstance(key, bytes) and self._probe(key, hash(key))[1] >= 0:
+            return True
+        return key in self._objects
+
+    def __getitem__(self, key):
+        if isinstance(key, bytes):
+            entry = self._probe(key, hash(key))[1]
+            if entry >= 0:
+                return bytes(self._data[self._splits[entry]:
+                                        self._stops[entry]])
+        return self._objects[key]
+
+    def get(self, key, default=None):
+        # Hot path for GET: _probe inlined, skipping tombstone tracking.
+        if isinstance(key, bytes):
+            h = hash(key)
+            table = self._table
+            mask = len(table) - 1
+            pos = h & mask
+            slot = table[pos]
+            while slot:
+                if slot > 0 and self._hashes[slot - 1] == h:
+                    entry = slot - 1
+                    data = self._data
+                    split = self._splits[entry]
+                    if data[self._starts[entry]:split] == key:
+                        return bytes(data[split:self._stops[entry]])
+                pos = (pos + 1) & mask
+                slot = table[pos]
+        return self._objects.get(key, default)
+
+    def __setitem__(self, key, value):
+        if not (isinstance(key, bytes) and isinstance(value, bytes)):
+            if isinstance(key, bytes):
+                self._discard(key)
+            self._objects[key] = value
+            return
+
+        h = hash(key)
+        pos, entry = self._probe(key, h)
+        if entry >= 0:
+            split, stop = self._splits[entry], self._stops[entry]
+            if len(value) <= stop - split:
+                # Fits in the old value's space; overwrite it in place.
+                self._data[split:split + len(value)] = value
+                self._stops[entry] = split + len(value)
+                self._garbage += stop - split - len(value)
+                return
+            self._garbage += stop - self._starts[entry]
+            start = len(self._data)
+            self._data += key
+            self._data += value
+            self._starts[entry] = start
+            self._splits[entry] = start + len(key)
+            self._stops[entry] = len(self._data)
+            self._maybe_compact()
+            return
+
+        if self._objects:
+            self._objects.pop(key, None)
+        start = len(self._data)
+        self._data += key
+        self._data += value
+        if self._table[pos] == 0:
+            self._used += 1
+        self._table[pos] = len(self._hashes) + 1
+        self._hashes.append(h)
+        self._starts.append(start)
+        self._splits.append(start + len(key))
+        self._stops.append(len(self._data))
+        self._live += 1
+        if 3 * self._used > 2 * len(self._table):
+            self._rebuild()
         else:
-            raise CommandError('Unrecognized type %s' % type(data))
+            self._maybe_compact()
+
+    def update(self, pairs):
+        for key, value in pairs:
+            self[key] = value
+
+    def __delitem__(self, key):
+        if not (isinstance(key, bytes) and self._discard(key)):
+            del self._objects[key]
+
+    def clear(self):
+        self.__init__()
+
+    def _probe(self, key, h):
+        # Return (position, entry) for key: entry is -1 when key is absent,
+        # in which case position is where it should be inserted.
+        table = self._table
+        mask = len(table) - 1
+        pos = h & mask
+        free = -1
+        while True:
+            slot = table[pos]
+            if slot == 0:
+                return (pos if free < 0 else free), -1
+            if slot < 0:
+                if free < 0:
+                    free = pos
+            else:
+                entry = slot - 1
+                if (self._hashes[entry] == h and
+                        self._data[self._starts[entry]:
+                                   self._splits[entry]] == key):
+                    return pos, entry
+            pos = (pos + 1) & mask
+
+    def _discard(self, key):
+        pos, entry = self._probe(key, hash(key))
+        if entry < 0:
+            return False
+        self._table[pos] = -1
+        self._garbage += self._stops[entry] - self._starts[entry]
+        self._live -= 1
+        self._maybe_compact()
+        return True
+
+    def _maybe_compact(self):
+        # Deleted entries leave both their bytes and their column slots
+        # behind; rebuild once either is mostly dead weight.
+        dead = len(self._hashes) - self._live
+        if ((self._garbage >= KV_COMPACT_MIN_GARBAGE and
+                2 * self._garbage > len(self._data)) or
+                dead > max(self._live, KV_MIN_TABLE_SIZE)):
+            self._rebuild()
+
+    def _rebuild(self):
+        # Copy the live entries into fresh columns and data, dropping dead
+        # ones and tombstones, and rehash them into a table at most 1/3 full.
+        size = KV_MIN_TABLE_SIZE
+        while size < 3 * self._live:
+            size *= 2
+        table = array('q', bytes(8 * size))
+        mask = size - 1
+        hashes, starts = array('q'), array('q')
+        splits, stops = array('q'), array('q')
+        data = bytearray()
+        with memoryview(self._data) as view:
+            for slot in self._table:
+                if slot <= 0:
+                    continue
+                entry = slot - 1
+                h = self._hashes[entry]
+                start = len(data)
+                data += view[self._starts[entry]:self._stops[entry]]
+                pos = h & mask
+                while table[pos]:
+                    pos = (pos + 1) & mask
+                table[pos] = len(hashes) + 1
+                hashes.append(h)
+                starts.append(start)
+                splits.append(start + self._splits[entry] -
+                              self._starts[entry])
+                stops.append(len(data))
+        self._table, self._used = table, self._live
+        self._hashes, self._starts = hashes, starts
+        self._splits, self._stops = splits, stops
+        self._data = data
+        self._garbage = 0
 
 
 class Server(object):
-    def __init__(self, host='127.0.0.1', port=31337, max_clients=64):
+    def __init__(self, host='127.0.0.1', port=31337, max_clients=64, kv=None):
+        # kv is the store backing the server: a plain dict by default, or
+        # e.g. a TypedKV for workloads dominated by bytes values.
         self._pool = Pool(max_clients)
         self._server = StreamServer(
             (host, port),
             self.connection_handler,
             spawn=self._pool)
-        self._protocol = ProtocolHandler()
-        self._kv = {}
-        self._commands = self.get_commands()
+        self._protocol = ProtocolHandler(bulk_scan=load_bulk_scan())
+        self._kv = {} if kv is None else kv
+        self._commands = self.compile_commands(self.get_commands())
+        self._command_names = {}
+        # Successfully handled array requests seen, by length.
+        self._hot = [0] * (SPECIALIZE_MAX_ARITY + 1)
 
     def get(self, key):
         return self._kv.get(key)
@@ -153,38 +783,125 @@ class Server(object):
         return kvlen
 
     def mget(self, *keys):
-        return [self._kv.get(keys) for key in keys]
+        return list(map(self._kv.get, keys))
 
     def mset(self, *items):
-        data = zip(items[::2], items[1::2])
-        for key, value in data:
-            self._kv[key] = value
+        self._kv.update(zip(items[::2], items[1::2]))
         return 1
 
     def get_commands(self):
+        # Maps each command to its method and how many arguments it takes
+        # (None for any number).
         return {
-            'GET': self.get,
-            'SET': self.set,
-            'DELETE': self.delete,
-            'FlUSH': self.flush,
-            'MGET': self.mget,
-            'MSET': self.mset
+            b'GET': (self.get, 1),
+            b'SET': (self.set, 2),
+            b'DELETE': (self.delete, 1),
+            b'FLUSH': (self.flush, 0),
+            b'MGET': (self.mget, None),
+            b'MSET': (self.mset, None)
         }
 
-    def connection_handler(self, conn, address):
-        socket_file = conn.makefile('rwb')
+    def compile_commands(self, commands):
+        # Generate a handler per command from _COMMAND_TEMPLATE with the
+        # command's arity patched in. Handlers take the whole request list;
+        # fixed-arity ones pass its arguments by index, so dispatch needs no
+        # slice or *args unpacking and a wrong argument count becomes an
+        # error reply rather than a TypeError.
+        handlers = {}
+        for name, (method, arity) in commands.items():
+            if arity is None:
+                source = _VARIADIC_COMMAND_TEMPLATE
+            else:
+                source = _COMMAND_TEMPLATE % {
+                    'size': arity + 1,
+                    'error': 'wrong number of arguments for %s' %
+                             name.decode('utf-8'),
+                    'args': ', '.join('a[%d]' % n
+                                      for n in range(1, arity + 1))}
+            namespace = {'method': method, 'CommandError': CommandError}
+            exec(source, namespace)
+            handlers[name] = namespace['handle']
+        return handlers
 
-        while True:
-            try:
-                data = self._protocol.handle_request(socket_file)
-            except Disconnect:
-                break
+    def connection_handler(self, conn, address):
+        buf = acquire_read_buffer()
+        pos = end = 0
+        out = acquire_buffer()
+        # Decoding progress on a request that has only partly arrived.
+        progress = None
 
-            try:
-                resp = self.get_response(data)
-            except CommandError as exc:
-                resp = Error(exc.args[0])
-            self._protocol.write_response(socket_file, resp)
+        try:
+            while True:
+                try:
+                    if progress is None:
+                        data, pos = self._protocol.handle_request(
+                            buf, pos, end)
+                    else:
+                        data, pos = self._protocol.resume(
+                            buf, pos, end, progress)
+                        progress = None
+                except Incomplete as exc:
+                    progress = exc.args or None
+                    # Every request received so far has been answered into
+                    # out; send the batch in one go before waiting for more.
+                    if out.tell():
+                        self._protocol.send(conn, out)
+                    try:
+                        buf, pos, end = self._protocol.fill(
+                            conn, buf, pos, end)
+                    except Disconnect:
+                        break
+                    continue
+                except Exception:
+                    # The rest of the stream cannot be parsed. Still send the
+                    # replies to the requests already handled before the
+                    # connection is dropped.
+                    if out.tell():
+                        self._protocol.send(conn, out)
+                    raise
+
+                try:
+                    resp = self.get_response(data)
+                except CommandError as exc:
+                    resp = Error(exc.args[0])
+                except Exception:
+                    # A bug rather than a bad request; it is not reported
+                    # to the client. Replies are batched, so send those to
+                    # the requests before it before dropping the connection.
+                    if out.tell():
+                        self._protocol.send(conn, out)
+                    raise
+                else:
+                    self._trace(data)
+                self._protocol.encode(out, resp)
+                if out.tell() >= BUF_MAX_SIZE:
+                    self._protocol.send(conn, out)
+        finally:
+            release_buffer(out)
+            release_read_buffer(buf)
+
+    def _trace(self, data):
+        # Count a successfully handled array request and, once requests of
+        # its length are hot, have the protocol handler specialise its
+        # decoder for this request's shape. Only lengths are counted, since
+        # working out the shape of every request costs more than the
+        # specialised decoder saves; clients send the same few shapes, so
+        # the request that makes a length hot almost always has the common
+        # one. Shapes with elements other than bulk and simple strings
+        # cannot be specialised, and start the count again.
+        if type(data) is not list:
+            return
+        length = len(data)
+        if (not 0 < length <= SPECIALIZE_MAX_ARITY or
+                length in self._protocol.specialized):
+            return
+        hot = self._hot
+        hot[length] += 1
+        if hot[length] >= HOT_SHAPE_THRESHOLD:
+            hot[length] = 0
+            shape = [_SHAPE_PREFIXES.get(type(item)) for item in data]
+            if None not in shape:
+                self._protocol.specialize(''.join(shape))
 
     def get_response(self, data):
         if not isinstance(data, list):
@@ -196,12 +913,25 @@ class Server(object):
         if not data:
             raise CommandError('Missing Command')
 
-        command = data[0].upper()
-        if command not in self._commands:
-            raise CommandError(f'Unrecognized command : {command}')
-
-
-        return self._commands[command](*data[1:])
+        # Commands are keyed by bytes, which is how clients normally send
+        # them (as bulk strings); only simple-string names need encoding.
+        # Clients repeat the same few names, so the normalised form of each
+        # name that resolved to a command is cached.
+        name = data[0]
+        if not isinstance(name, (bytes, str)):
+            raise CommandError('Request must be list or simple string')
+        command = self._command_names.get(name)
+        if command is None:
+            command = name.encode('utf-8') if isinstance(name, str) else name
+            command = command.upper()
+            if command not in self._commands:
+                # Error messages go out verbatim; repr() escapes any CR or
+                # LF in the name, which would end the reply early.
+                raise CommandError('Unrecognized command : %r' % command)
+            if len(self._command_names) < COMMAND_CACHE_SIZE:
+                self._command_names[name] = command
+
+        return self._commands[command](data)
 
     def run(self):
         self._server.serve_forever()
@@ -0,0 +1,460 @@
+import random
+import unittest
+
+import database_server
+from database_server import (ProtocolHandler, Server, TypedKV, CommandError,
+                             Error, Incomplete, Disconnect,
+                             HOT_SHAPE_THRESHOLD, KV_COMPACT_MIN_GARBAGE,
+                             KV_MIN_TABLE_SIZE, NUMBA_MIN_ELEMENTS,
+                             SPLICE_MIN_SIZE, acquire_buffer, load_bulk_scan)
+
+
+class FakeConn(object):
+    # Stands in for a socket, handing out data at most chunk bytes per read.
+    def __init__(self, data, chunk):
+        self.data = data
+        self.chunk = chunk
+        self.offset = 0
+        self.reads = 0
+
+    def recv_into(self, view):
+        size = min(len(view), self.chunk, len(self.data) - self.offset)
+        view[:size] = self.data[self.offset:self.offset + size]
+        self.offset += size
+        self.reads += 1
+        return size
+
+
+class TestDecode(unittest.TestCase):
+    def setUp(self):
+        self.protocol = ProtocolHandler()
+
+    def decode(self, data, chunk=None, buf_size=16):
+        # Decode every value in data, received chunk bytes at a time, the
+        # way Server.connection_handler does.
+        conn = FakeConn(data, chunk or len(data))
+        buf = bytearray(buf_size)
+        pos = end = 0
+        progress = None
+        values = []
+        while True:
+            try:
+                if progress is None:
+                    value, pos = self.protocol.handle_request(buf, pos, end)
+                else:
+                    value, pos = self.protocol.resume(buf, pos, end,
+                                                      progress)
+                    progress = None
+            except Incomplete as exc:
+                progress = exc.args or None
+                try:
+                    buf, pos, end = self.protocol.fill(conn, buf, pos, end)
+                except Disconnect:
+                    return values
+                continue
+            values.append(value)
+
+    def test_values(self):
+        data = (b'+OK\r\n-ERR bad\r\n:-12\r\n$3\r\nfoo\r\n$0\r\n\r\n'
+                b'$-1\r\n*2\r\n$1\r\na\r\n:1\r\n*-1\r\n'
+                b'%2\r\n+k\r\n*1\r\n$1\r\nv\r\n$2\r\nk2\r\n:3\r\n')
+        self.assertEqual(self.decode(data), [
+            'OK', Error('ERR bad'), -12, b'foo', b'', None, [b'a', 1], [],
+            {'k': [b'v'], b'k2': 3}])
+
+    def test_split_reads(self):
+        # Every way of splitting the stream gives the same values.
+        data = (b'*3\r\n$3\r\nSET\r\n$3\r\nkey\r\n$12\r\nhello\r\nworld\r\n'
+                b'*2\r\n*2\r\n:1\r\n$2\r\nab\r\n%1\r\n+k\r\n*1\r\n:2\r\n'
+                b'$-1\r\n')
+        expected = self.decode(data)
+        self.assertEqual(expected, [
+            [b'SET', b'key', b'hello\r\nworld'],
+            [[1, b'ab'], {'k': [2]}],
+            None])
+        for chunk in range(1, len(data)):
+            self.assertEqual(self.decode(data, chunk), expected, chunk)
+
+    def test_resume(self):
+        # A large array arriving over many reads is decoded in one pass,
+        # each read carrying on from the last complete element.
+        items = [b'key:%04d' % i for i in range(1000)]
+        data = b'*%d\r\n' % len(items) + b''.join(
+            b'$%d\r\n%s\r\n' % (len(item), item) for item in items)
+        conn = FakeConn(data, 7)
+        buf = bytearray(len(data))
+        pos = end = 0
+        progress = None
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                if progress is None:
+                    value, pos = self.protocol.handle_request(buf, pos, end)
+                else:
+                    value, pos = self.protocol.resume(buf, pos, end,
+                                                      progress)
+                break
+            except Incomplete as exc:
+                # There is no progress to keep until the header is in.
+                progress = exc.args or None
+                if end - pos >= 7:
+                    self.assertLessEqual(progress[0], end - pos)
+                buf, pos, end = self.protocol.fill(conn, buf, pos, end)
+        self.assertEqual(value, items)
+        self.assertEqual(pos, len(data))
+        self.assertEqual(attempts, conn.reads + 1)
+
+    def test_large_buffer_growth(self):
+        value = b'x' * 1000
+        data = b'*2\r\n$3\r\nGET\r\n$1000\r\n%s\r\n' % value
+        self.assertEqual(self.decode(data, 64), [[b'GET', value]])
+
+    def test_bad_lengths(self):
+        for data in (b'$-2\r\n', b'$-1000\r\nabc\r\n', b'*-2\r\n',
+                     b'%-5\r\n', b'*2\r\n$1\r\na\r\n$-3\r\n'):
+            with self.assertRaises(CommandError, msg=data):
+                self.protocol.handle_request(bytearray(data), 0, len(data))
+
+    def test_bad_prefix(self):
+        data = bytearray(b'!bogus\r\n')
+        with self.assertRaises(CommandError):
+            self.protocol.handle_request(data, 0, len(data))
+
+
+class TestSpecialized(TestDecode):
+    # Runs every decoder test again with specialised decoders installed.
+    def setUp(self):
+        self.protocol = ProtocolHandler()
+        for shape in ('$', '$$', '$$$', '+$', '$$$$'):
+            self.protocol.specialize(shape)
+
+    def test_specialized(self):
+        data = bytearray(b'*2\r\n+GET\r\n$3\r\nkey\r\n')
+        self.assertEqual(self.protocol.handle_request(data, 0, len(data)),
+                         (['GET', b'key'], len(data)))
+        # Arrays of the same length but another shape use the generic
+        # decoder.
+        data = bytearray(b'*2\r\n:1\r\n$-1\r\n*3\r\n$1\r\na\r\n$-1\r\n:2\r\n')
+        self.assertEqual(self.decode(bytes(data)),
+                         [[1, None], [b'a', None, 2]])
+
+
+class TestBulkScan(TestDecode):
+    # Runs every decoder test again with the compiled scan, plus its own.
+    def setUp(self):
+        bulk_scan = load_bulk_scan()
+        if bulk_scan is None:
+            self.skipTest('numba is not installed')
+        self.protocol = ProtocolHandler(bulk_scan=bulk_scan)
+
+    def test_scan(self):
+        items = [b'%d' % i * (i % 5) for i in range(NUMBA_MIN_ELEMENTS)]
+        data = bytearray(b'*%d\r\n' % len(items) + b''.join(
+            b'$%d\r\n%s\r\n' % (len(item), item) for item in items))
+        self.assertEqual(self.protocol.handle_request(data, 0, len(data)),
+                         (items, len(data)))
+        self.assertEqual(self.decode(bytes(data), 100), [items])
+
+    def test_scan_falls_back(self):
+        # Anything but bulk strings is left to the generic decoder.
+        items = [b'a', None, 7] * NUMBA_MIN_ELEMENTS
+        data = bytearray(b'*%d\r\n' % len(items) + b'$1\r\na\r\n$-1\r\n:7\r\n'
+                         * NUMBA_MIN_ELEMENTS)
+        self.assertEqual(self.protocol.handle_request(data, 0, len(data)),
+                         (items, len(data)))
+
+    def test_long_length(self):
+        # A length too long for int64 must not wrap round to a position
+        # before the request, here placed after earlier pipelined requests.
+        for length in (b'18446744073709550792', b'9' * 19, b'99999999'):
+            data = bytearray(b':1\r\n' * 1000 +
+                             b'*%d\r\n' % NUMBA_MIN_ELEMENTS +
+                             b'$0\r\n\r\n' * (NUMBA_MIN_ELEMENTS - 1) +
+                             b'$%s\r\n' % length)
+            with self.assertRaises(Incomplete):
+                self.protocol.handle_request(data, 4000, len(data))
+
+
+class SendConn(object):
+    # Collects what is sent, accepting at most chunk bytes per sendmsg().
+    def __init__(self, chunk=1000, fail=False):
+        self.chunk = chunk
+        self.fail = fail
+        self.sent = bytearray()
+
+    def sendall(self, data):
+        if self.fail:
+            raise OSError('connection reset')
+        self.sent += data
+
+    def sendmsg(self, buffers):
+        if self.fail:
+            raise OSError('connection reset')
+        data = b''.join(buffers)[:self.chunk]
+        self.sent += data
+        return len(data)
+
+
+class ServerConn(FakeConn, SendConn):
+    def __init__(self, data):
+        FakeConn.__init__(self, data, 5)
+        SendConn.__init__(self)
+
+
+class TestEncode(unittest.TestCase):
+    def setUp(self):
+        self.protocol = ProtocolHandler()
+
+    def round_trip(self, value, conn=None):
+        conn = conn or SendConn()
+        self.protocol.write_response(conn, value)
+        data = bytearray(conn.sent)
+        decoded, pos = self.protocol.handle_request(data, 0, len(data))
+        self.assertEqual(pos, len(data))
+        return decoded
+
+    def test_values(self):
+        value = [b'a', 'b', 1, None, Error('bad'), [b'c', [2]], {'k': b'v'},
+                 (b'd',), True]
+        self.assertEqual(self.round_trip(value), [
+            b'a', 'b', 1, None, Error('bad'), [b'c', [2]], {'k': b'v'},
+            [b'd'], 1])
+
+    def test_spliced(self):
+        # Large payloads go out by reference, over several sendmsg() calls.
+        big = [bytes([65 + i]) * (SPLICE_MIN_SIZE + i) for i in range(5)]
+        value = [b'small', big[0], big[1], 3, big[2:]]
+        self.assertEqual(self.round_trip(value, SendConn(chunk=3000)),
+                         [b'small', big[0], big[1], 3, big[2:]])
+
+    def test_failed_send(self):
+        # A buffer whose send failed is not pooled: the traceback still
+        # refers to slices of it.
+        for value in ([b'x' * SPLICE_MIN_SIZE, b'y'], [b'small']):
+            database_server._buf_pool.clear()
+            with self.assertRaises(OSError) as ctx:
+                self.protocol.write_response(SendConn(fail=True), value)
+            self.assertEqual(len(database_server._buf_pool), 0)
+            buf = acquire_buffer()
+            buf.write(b'still writable')
+            database_server.release_buffer(buf)
+            del ctx
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.server = Server(port=0)
+
+    def test_trace(self):
+        # A length of request is specialised for the shape of the request
+        # that makes it hot, unless that shape cannot be specialised.
+        protocol = self.server._protocol
+        for _ in range(HOT_SHAPE_THRESHOLD - 1):
+            self.server._trace([b'GET', b'k'])
+        self.server._trace([b'GET', 1])
+        self.assertEqual(protocol.specialized, {})
+        for _ in range(HOT_SHAPE_THRESHOLD - 1):
+            self.server._trace([b'SET', b'k', b'v'])
+        self.assertEqual(protocol.specialized, {})
+        self.server._trace([b'SET', 'k', b'v'])
+        self.assertEqual(list(protocol.specialized), [3])
+        data = bytearray(b'*3\r\n$3\r\nSET\r\n+k\r\n$1\r\nv\r\n')
+        self.assertEqual(protocol.handle_request(data, 0, len(data)),
+                         ([b'SET', 'k', b'v'], len(data)))
+
+    def serve(self, data):
+        # Run the connection handler over one connection sending data,
+        # returning everything it sent back.
+        conn = ServerConn(data)
+        self.server.connection_handler(conn, None)
+        return bytes(conn.sent)
+
+    def test_connection(self):
+        data = (b'*3\r\n$3\r\nSET\r\n$1\r\na\r\n$1\r\nb\r\n'
+                b'*2\r\n$3\r\nGET\r\n$1\r\na\r\n'
+                b'*1\r\n$4\r\nNOPE\r\n*1\r\n$3\r\nGET\r\n'
+                b'+GET a\r\n*2\r\n*1\r\n$1\r\nx\r\n$1\r\na\r\n'
+                b'*2\r\n:5\r\n$1\r\na\r\n$-1\r\n*0\r\n')
+        self.assertEqual(self.serve(data), (
+            b':1\r\n$1\r\nb\r\n'
+            b"-Unrecognized command : b'NOPE'\r\n"
+            b'-wrong number of arguments for GET\r\n'
+            b'$-1\r\n'
+            b'-Request must be list or simple string\r\n'
+            b'-Request must be list or simple string\r\n'
+            b'-Request must be list or simple string\r\n'
+            b'-Missing Command\r\n'))
+
+    def test_connection_errors(self):
+        # Replies to the requests before one that cannot be decoded, or
+        # that fails inside the server, are sent before the connection is
+        # dropped.
+        set_ab = b'*3\r\n$3\r\nSET\r\n$1\r\na\r\n$1\r\nb\r\n'
+        conn = ServerConn(set_ab + b'!bogus\r\n' + set_ab)
+        self.assertRaises(CommandError, self.server.connection_handler,
+                          conn, None)
+        self.assertEqual(bytes(conn.sent), b':1\r\n')
+        # An unhashable key is not a CommandError, so it is not reported.
+        conn = ServerConn(set_ab + b'*2\r\n$3\r\nGET\r\n*0\r\n' + set_ab)
+        self.assertRaises(TypeError, self.server.connection_handler,
+                          conn, None)
+        self.assertEqual(bytes(conn.sent), b':1\r\n')
+
+    def test_unrecognized_command(self):
+        for name in (b'NOPE\r\n:99', 'nope\r\n:99'):
+            with self.assertRaises(CommandError) as ctx:
+                self.server.get_response([name, b'k'])
+            message = ctx.exception.args[0]
+            self.assertEqual(message,
+                             "Unrecognized command : b'NOPE\\r\\n:99'")
+            self.assertNotIn('\r', message)
+            self.assertNotIn('\n', message)
+
+
+class TestTypedKV(unittest.TestCase):
+    def setUp(self):
+        self.kv = TypedKV()
+
+    def colliding_keys(self, count):
+        # Keys that all start probing at the same table position.
+        mask = len(self.kv._table) - 1
+        keys = []
+        i = 0
+        while len(keys) < count:
+            key = b'key:%d' % i
+            if hash(key) & mask == 0:
+                keys.append(key)
+            i += 1
+        return keys
+
+    def test_dict_interface(self):
+        kv = self.kv
+        kv[b'a'] = b'1'
+        kv.update([(b'b', b'22'), ('c', 3), (b'd', [4])])
+        self.assertEqual(len(kv), 4)
+        self.assertEqual(kv[b'a'], b'1')
+        self.assertEqual(kv.get(b'b'), b'22')
+        self.assertEqual(kv['c'], 3)
+        self.assertEqual(kv.get(b'd'), [4])
+        self.assertIsNone(kv.get(b'missing'))
+        self.assertEqual(kv.get(b'missing', 0), 0)
+        self.assertIn(b'a', kv)
+        self.assertNotIn(b'missing', kv)
+        self.assertRaises(KeyError, lambda: kv[b'missing'])
+        # Changing the type of a key's value moves it between the packed
+        # table and the dict of other objects.
+        kv[b'a'] = 5
+        self.assertEqual(kv[b'a'], 5)
+        kv[b'd'] = b'4'
+        self.assertEqual(kv[b'd'], b'4')
+        self.assertEqual(len(kv), 4)
+        del kv[b'a'], kv['c']
+        self.assertRaises(KeyError, kv.__delitem__, b'a')
+        self.assertEqual(len(kv), 2)
+        kv.clear()
+        self.assertEqual(len(kv), 0)
+        self.assertIsNone(kv.get(b'b'))
+
+    def test_bytes_subclass(self):
+        class Key(bytes):
+            pass
+
+        self.kv[Key(b'k')] = b'v'
+        for key in (b'k', Key(b'k')):
+            self.assertEqual(self.kv[key], b'v')
+            self.assertEqual(self.kv.get(key), b'v')
+            self.assertIn(key, self.kv)
+        self.kv[b'k'] = Key(b'w')
+        self.assertEqual(self.kv.get(Key(b'k')), b'w')
+        self.assertEqual(len(self.kv), 1)
+
+    def test_probe_and_tombstones(self):
+        kv = self.kv
+        first, second, third = self.colliding_keys(3)
+        kv[first] = b'1'
+        kv[second] = b'2'
+        del kv[first]
+        # The deleted first key leaves a tombstone that lookups of the
+        # second probe past, and that the next colliding insert reuses.
+        self.assertIn(-1, kv._table)
+        self.assertEqual(kv[second], b'2')
+        self.assertNotIn(first, kv)
+        used = kv._used
+        kv[third] = b'3'
+        self.assertEqual(kv._used, used)
+        self.assertNotIn(-1, kv._table)
+        self.assertEqual((kv.get(second), kv.get(third)), (b'2', b'3'))
+
+    def test_overwrite_in_place(self):
+        kv = self.kv
+        kv[b'k'] = b'long value'
+        size = len(kv._data)
+        kv[b'k'] = b'short'
+        self.assertEqual(len(kv._data), size)
+        self.assertEqual(kv[b'k'], b'short')
+        kv[b'k'] = b'a longer value'
+        self.assertGreater(len(kv._data), size)
+        self.assertEqual(kv[b'k'], b'a longer value')
+        self.assertEqual(len(kv._hashes), 1)
+
+    def test_rebuild(self):
+        kv = self.kv
+        keys = [b'key:%d' % i for i in range(1000)]
+        for key in keys:
+            kv[key] = key[::-1]
+        # The table grew to stay at most 2/3 full.
+        self.assertGreater(len(kv._table), KV_MIN_TABLE_SIZE)
+        self.assertLessEqual(3 * kv._used, 2 * len(kv._table))
+        for key in keys[::2]:
+            del kv[key]
+        # Deleted entries are dropped once they outnumber the live ones.
+        self.assertLessEqual(len(kv._hashes) - kv._live,
+                             max(kv._live, KV_MIN_TABLE_SIZE))
+        for key in keys:
+            self.assertEqual(kv.get(key),
+                             None if key in keys[::2] else key[::-1])
+
+    def test_compact(self):
+        kv = self.kv
+        kv[b'other'] = b'o'
+        # Each value is longer than the last, so none fits in place and
+        # about 4 * KV_COMPACT_MIN_GARBAGE bytes are written in all.
+        for size in range(1024, 1280):
+            kv[b'key'] = b'x' * size
+        # Overwritten values are reclaimed once they are more than half
+        # the data (and at least KV_COMPACT_MIN_GARBAGE bytes).
+        self.assertLess(kv._garbage, KV_COMPACT_MIN_GARBAGE)
+        self.assertLess(len(kv._data), 2 * KV_COMPACT_MIN_GARBAGE)
+        self.assertEqual(kv[b'key'], b'x' * 1279)
+        self.assertEqual(kv[b'other'], b'o')
+
+    def test_against_dict(self):
+        kv, ref = self.kv, {}
+        rnd = random.Random(1)
+        for _ in range(20000):
+            key = rnd.choice([b'k%d' % rnd.randrange(500),
+                              's%d' % rnd.randrange(20)])
+            op = rnd.random()
+            if op < 0.55:
+                if rnd.random() < 0.9:
+                    value = bytes(rnd.randrange(256)
+                                  for _ in range(rnd.randrange(20)))
+                else:
+                    value = rnd.randrange(9)
+                kv[key] = ref[key] = value
+            elif op < 0.75:
+                if key in ref:
+                    del kv[key], ref[key]
+                else:
+                    self.assertRaises(KeyError, kv.__delitem__, key)
+            else:
+                self.assertEqual(kv.get(key), ref.get(key))
+                self.assertEqual(key in kv, key in ref)
+            self.assertEqual(len(kv), len(ref))
+        for key, value in ref.items():
+            self.assertEqual(kv[key], value)
+
+
+if __name__ == '__main__':
+    unittest.main()